@@ -1,3 +1,8 @@
+import functools
+import operator
+from collections import defaultdict, deque
+from itertools import chain
+
 # Provides easy-to-ease compare features for Python objects.
 #
 # To use, create a comparator as a constant:
@@ -25,9 +30,23 @@
 # strange bugs. (Remember, lists and dicts use eq() and hash() heavily.)
 #
 class GenericComparator(object):
+    __slots__ = ('fieldnames', '_getter')
+
     def __init__(self, fieldnames = []):
         self.fieldnames = fieldnames
 
+        # attrgetter fetches every field in one C-level call. Given a
+        # single field it returns the bare value, which we compare on
+        # directly rather than wrapping it in a tuple.
+        if len(fieldnames) == 1:
+            self._getter = operator.attrgetter(fieldnames[0])
+
+        elif fieldnames:
+            self._getter = operator.attrgetter(*fieldnames)
+
+        else:
+            self._getter = lambda o: ()
+
     def _yield_field_values(self, o1, o2):
         for fieldname in self.fieldnames:
             o1val = getattr(o1, fieldname)
@@ -36,25 +55,48 @@ class GenericComparator(object):
             yield (o1val, o2val)
 
     def _key(self, o):
-        return [(getattr(o, x)) for x in self.fieldnames]
+        return self._getter(o)
 
     def eq(self, o1, o2):
-        return self._key(o1) == self._key(o2)
+        getter = self._getter
+        return getter(o1) == getter(o2)
 
     def ne(self, o1, o2):
-        return self._key(o1) != self._key(o2)
+        getter = self._getter
+        return getter(o1) != getter(o2)
 
     def lt(self, o1, o2):
-        return self._key(o1) < self._key(o2)
+        getter = self._getter
+        return getter(o1) < getter(o2)
 
     def gt(self, o1, o2):
-        return self._key(o1) > self._key(o2)
+        getter = self._getter
+        return getter(o1) > getter(o2)
+
+# Return a function that gets field_name from a data item, for grouping.
+#
+# If field_name contains brackets or full stops, it is
+# probably code making a function call or digging into
+# field values several depths down.
+# In which case we eval() this code into a function.
+# Dangerous but handy.
+#
+# Accessors are cached, so grouping every leaf of a tree by the same
+# field_name only compiles the code once.
+@functools.lru_cache(maxsize=128)
+def _make_accessor(field_name):
+    if ('.' in field_name) or ('(' in field_name):
+        return eval('lambda d: d.' + field_name)
+
+    return operator.attrgetter(field_name)
 
 # RollerUpper - a Python implementation of fstat's TransactionAnalyser,
 # abstracted to be usable with any class containing any fields.
 #
 RU_COMPARATOR = GenericComparator(['name'])
 class RollerUpper(object):
+    __slots__ = ('name', 'key', 'children', '_data')
+
     # name can be anything, including None
     # key can also be anything, including None
     #
@@ -63,21 +105,33 @@ class RollerUpper(object):
     #
     # either data or children must be specified
     def __init__(self, name = None, key = None, data = None, children = None):
-        asrt(not (data == None and children == None), 'data or children must be specified')
+        asrt(not (data is None and children is None), 'data or children must be specified')
         asrt(not (data and children), 'data or children must be specified, not both')
 
         self.name = name
         self.key = key
 
-        if data != None:
-            self.data = data
+        if data is not None:
+            self._data = data
             self.children = None
 
-        if children != None:
+        if children is not None:
             self.children = children
-            self.data = []
-            for c in self.children:
-                self.data.extend(c.data)
+            # data is gathered from the children on first access
+            self._data = None
+
+    # The data items in this RU. If it was built from children, this is
+    # flattened from their data the first time it is asked for.
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = list(chain.from_iterable(c.data for c in self.children))
+
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
 
     def __gt__(self, other):
         return RU_COMPARATOR.gt(self, other)
@@ -85,6 +139,40 @@ class RollerUpper(object):
     def __lt__(self, other):
         return RU_COMPARATOR.lt(self, other)
 
+    # Build an RU from records already grouped by an integer key, such as
+    # a year or month number. keys should be a numpy array (or anything
+    # numpy can turn into one) holding the key of each item in records,
+    # so keys[i] is the key for records[i].
+    #
+    # This gives the same children as grouping RollerUpper(data=records)
+    # by that key, but the grouping itself is done by numpy rather than
+    # item by item in Python, which is much faster for big data sets.
+    #
+    # numpy is only needed if this is used.
+    @classmethod
+    def from_arrays(cls, name, keys, records):
+        import numpy as np
+
+        keys = np.asarray(keys)
+        # an empty list comes through as float, but there is nothing to check
+        asrt(len(keys) == 0 or np.issubdtype(keys.dtype, np.integer), 'keys must be integers')
+        asrt(len(keys) == len(records), 'keys and records must be the same length')
+
+        # a stable sort keeps records in their original order within
+        # each group, as _group_by does
+        order = np.argsort(keys, kind='stable')
+        values, starts = np.unique(keys[order], return_index=True)
+        ends = np.append(starts[1:], len(keys))
+
+        children = []
+        for (k, start, end) in zip(values.tolist(), starts.tolist(), ends.tolist()):
+            data = [records[i] for i in order[start:end].tolist()]
+            children.append(RollerUpper(name=str(k), key=k, data=data))
+
+        children.sort(key=RU_COMPARATOR._getter)
+
+        return cls(name=name, children=children)
+
 
     # Group a hierarchy of RUs by a named field in each data item.
     #
@@ -97,7 +185,7 @@ class RollerUpper(object):
     #
     # Note, field_name can also be a code snippet, provided as a string.
     # If field_name contains '.' or '(', this function assumes it is a
-    # code snippet of some sort and will exec() it, prepending the item.
+    # code snippet of some sort and will eval() it, prepending the item.
     # For example, if the RU contains orders, containing dates, I can call
     # group_hierarchy_by('date.year') to group the orders by year (assuming
     # the date field is called 'date' of course). I could also do
@@ -107,93 +195,117 @@ class RollerUpper(object):
     # With CGIWeeks, this allows us to do week.month, or week.month.fy.
     #
     def group_hierarchy_by(self, field_name, name_field = None):
-        if self.children == None:
-            self._group_by(field_name, name_field)
+        # walk the tree with an explicit stack rather than recursing,
+        # so deep hierarchies don't hit the recursion limit
+        stack = deque([self])
+        while stack:
+            ru = stack.pop()
+            if ru.children is None:
+                ru._group_by(field_name, name_field)
 
-        else:
-            for c in self.children:
-                c.group_hierarchy_by(field_name, name_field)
+            else:
+                stack.extend(ru.children)
 
     # Clear all groupings
     def reset(self):
+        # make sure data has been gathered before the children go
+        self._data = self.data
         self.children = None
 
     def _group_by(self, field_name, name_field = None):
-        # If field_name contains brackets or full stops, it is
-        # probably code making a function call or digging into
-        # field values several depths down.
-        # In which case we use exec() to execute this code directly.
-        # Dangerous but handy.
-        do_exec = ('.' in field_name) or ('(' in field_name)
+        accessor = _make_accessor(field_name)
 
-        group = {}
+        group = defaultdict(list)
 
         for d in self.data:
-            if do_exec:
-                exec('val = d.' + field_name)
-
-            else:
-                val = getattr(d, field_name)
-
-            if val not in list(group.keys()):
-                group[val] = []
+            group[accessor(d)].append(d)
 
-            group[val].append(d)
+        # items without a value are gathered into a single 'Unknown' RU
+        unknown_data = group.pop(None, None)
 
-        unknown_data = []
         self.children = []
         for (k, v) in group.items():
             name = str(k)
             key = k
-            if key == None:
-                unknown_data.extend(v)
-
-            else:
-                if name_field:
-                    key = getattr(k, name_field)
-                    name = str(key)
+            if name_field:
+                key = getattr(k, name_field)
+                name = str(key)
 
-                self.children.append(RollerUpper(name=name, key=key, data=v))
+            self.children.append(RollerUpper(name=name, key=key, data=v))
 
         if unknown_data:
             self.children.append(RollerUpper(name='Unknown', key=None, data=unknown_data))
 
-        self.children.sort()
+        # sort on the comparator's key getter directly, so it is computed
+        # once per child rather than twice per comparison
+        self.children.sort(key=RU_COMPARATOR._getter)
 
     def get_first(self, field_name):
         if not self.data: return None
         return getattr(self.data[0], field_name)
 
     def get_all(self, field_name):
-        result = []
-        for d in self.data:
-            val = getattr(d, field_name)
-            result.append(val)
+        return list(map(operator.attrgetter(field_name), self.data))
 
-        return result
+    # Like get_all() but returns a numpy array of the given dtype, for
+    # numeric fields that are going on to be analysed with numpy.
+    #
+    # numpy is only needed if this is used.
+    def get_all_np(self, field_name, dtype = float):
+        import numpy as np
+
+        data = self.data
+        return np.fromiter(map(operator.attrgetter(field_name), data),
+                           dtype=dtype, count=len(data))
 
     def __iter__(self):
         for c in self.data:
             yield c
 
+    # Note this only gives counts, so it stays cheap on big trees;
+    # use pretty() to see everything.
     def __repr__(self):
         return 'RollerUpper[name=' + str(self.name) + \
-               ',len_children=' + str(len(max(self.children, []))) + \
-               ',len_data=' + str(len(self.data)) + \
-               ',children=' + str(self.children) + \
-               ',data=' + str(self.data) + \
+               ',len_children=' + str(0 if self.children is None else len(self.children)) + \
+               ',len_data=' + str(self._len_data()) + \
                ']'
 
+    # The number of data items in this RU, counted from the children
+    # if the data hasn't been gathered yet, so it isn't built just to
+    # be counted.
+    def _len_data(self):
+        if self._data is not None:
+            return len(self._data)
+
+        return sum(c._len_data() for c in self.children)
+
+    # A full dump of this RU tree, one RU per line and indented by
+    # depth, with the data items listed beneath each leaf.
+    def pretty(self, indent = 0):
+        lines = ['  ' * indent + repr(self)]
+        if self.children is None:
+            lines.append('  ' * (indent + 1) + str(self._data))
+
+        else:
+            for c in self.children:
+                lines.append(c.pretty(indent + 1))
+
+        return '\n'.join(lines)
+
     def get_all_children_names(self):
-        return [ x.name for x in self.children ]
+        return list(map(operator.attrgetter('name'), self.children))
 
     # Get all 'leaf' nodes in this RU tree - i.e. all the children
     # as far down as each line of RUs will go.
     def get_all_children(self):
         result = []
-        for c in self.children:
-            if c.children != None:
-                result.extend(c.get_all_children())
+
+        # children are pushed in reverse so leaves come out in tree order
+        stack = deque(reversed(self.children))
+        while stack:
+            c = stack.pop()
+            if c.children is not None:
+                stack.extend(reversed(c.children))
 
             else:
                 result.append(c)
@@ -206,29 +318,40 @@ class RollerUpper(object):
     # _first_only is an internal arg used to implement get_child(),
     # 	it causes the function to return once an item has been found
     def get_children(self, name=None, key=None, recursive = True, _first_only = False):
+        asrt(not (name is None and key is None), 'must specify name or key')
+
+        # since all names are strings, insist on string comparison
+        name_str = None if name is None else str(name)
+
         result = []
-        asrt(not (name == None and key == None), 'must specify name or key')
+        self._collect_children(name_str, key, recursive, _first_only, result)
 
-        # note: currently this will blow up if there are children == None
+        return RollerUpper(name=name, key=key, children=result)
+
+    # Does the work for get_children(), appending matches to out rather
+    # than building a RollerUpper at every level. name_str is the name
+    # already converted to a string. Returns True if first_only is set
+    # and a match has been found, so callers can stop.
+    def _collect_children(self, name_str, key, recursive, first_only, out):
+        # note: currently this will blow up if self.children is None
         for c in self.children:
-            # since all names are strings, insist on string comparison
-            if name != None:
-                if str(c.name) == str(name): result.append(c)
-            elif key != None:
-                if c.key == key: result.append(c)
+            if name_str is not None:
+                if str(c.name) == name_str: out.append(c)
+            elif c.key == key:
+                out.append(c)
 
-            if recursive and c.children != None:
-                result.extend(c.get_children(name=name, key=key,
-                                             recursive=recursive).children)
+            if first_only and out: return True
 
-            if _first_only and result: break
+            if recursive and c.children is not None:
+                if c._collect_children(name_str, key, recursive, first_only, out):
+                    return True
 
-        return RollerUpper(name=name, key=key, children=result)
+        return False
 
     # get_children but returns only the first item found, or None
     # if it wasn't found
     def get_child(self, name, recursive = True):
-        result = self.get_children(name, recursive, _first_only=True)
+        result = self.get_children(name=name, recursive=recursive, _first_only=True)
 
         if result.children: return result.children[0]
         return None
@@ -245,6 +368,8 @@ class RollerUpper(object):
 # easy analysis without having to become mutable.
 #
 class ImmutableRollerUpper(RollerUpper):
+    __slots__ = ()
+
     def __init__(self, name = None, data = None, children = None):
         RollerUpper.__init__(self, name=name, data=data, children=children)
 
@@ -257,8 +382,25 @@ class ImmutableRollerUpper(RollerUpper):
 
     # return a mutable copy of this IRU
     def mutable(self):
-        # return a new RU instance first
-        return RollerUpper(name=self.name, data=self.data, children=self.children)
+        if self.children is None:
+            return RollerUpper(name=self.name, data=self.data)
+
+        # copy the tree of RUs so grouping the copy can't change ours,
+        # but share each leaf's data rather than copying the items
+        result = RollerUpper(name=self.name, children=[])
+        stack = deque([(self, result)])
+        while stack:
+            (ru, copy) = stack.pop()
+            for c in ru.children:
+                if c.children is None:
+                    copy.children.append(RollerUpper(name=c.name, key=c.key, data=c.data))
+
+                else:
+                    c_copy = RollerUpper(name=c.name, key=c.key, children=[])
+                    copy.children.append(c_copy)
+                    stack.append((c, c_copy))
+
+        return result
 
     def reset(self):
         # do nothing